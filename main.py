@@ -4,9 +4,20 @@ Matrix Widgets Plugin - 提供 Matrix 小组件管理命令
 此插件依赖于 astrbot_plugin_matrix_adapter 提供的 Matrix 客户端。
 """
 
-import secrets
+import asyncio
+import functools
+import inspect
+import itertools
+import json
+import re
+import time
 import urllib.parse
-from typing import TYPE_CHECKING
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from operator import itemgetter
+from os import urandom
+from typing import TYPE_CHECKING, ClassVar, TypeVar
 
 import aiohttp
 
@@ -14,84 +25,265 @@ from astrbot.api import logger
 from astrbot.api.event import AstrMessageEvent, filter
 from astrbot.api.star import Context, Star
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 if TYPE_CHECKING:
     from astrbot_plugin_matrix_adapter.client import MatrixHTTPClient
 
+# 视为 Matrix 的平台适配器名称
+_MATRIX_PLATFORMS = frozenset({"matrix"})
+_ERR_NOT_MATRIX = "此命令仅在 Matrix 平台可用"
+
+# 音乐搜索结果缓存有效期 (秒)
+_SEARCH_CACHE_TTL = 60
+
+# 音乐搜索请求头
+_COMMON_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+_NETEASE_HEADERS = {"User-Agent": _COMMON_UA, "Referer": "https://music.163.com/"}
+_QQ_HEADERS = {"User-Agent": _COMMON_UA, "Referer": "https://y.qq.com/"}
+_YT_HEADERS = {"User-Agent": _COMMON_UA}
+
+# 匹配 YouTube 链接中的视频 ID (watch?v= / youtu.be / embed / v)
+_YT_RE = re.compile(r"(?:youtu\.be/|youtube\.com/(?:watch\?(?:.*&)?v=|embed/|v/))([\w-]{6,})")
+# 匹配 Spotify 曲目链接中的 22 位 track ID (可带 intl-xx 前缀)
+_SPOTIFY_RE = re.compile(r"spotify\.com/(?:intl-[\w-]+/)?track/([A-Za-z0-9]{22})")
+
+# 音乐平台标识 -> 显示名称
+_PLATFORM_DISPLAY_NAMES: dict[str, str] = {
+    "netease": "网易云音乐",
+    "qq": "QQ 音乐",
+    "youtube": "YouTube",
+    "spotify": "Spotify",
+}
+
+# 取歌手列表中每项的 name 字段
+_get_name = itemgetter("name")
+
+# 小组件命令的回复模板
+_ADD_TMPL = "已添加小组件 **{name}**\nID: `{wid}`\n类型：{wtype}\nURL: {url}"
+_CUSTOM_TMPL = "已添加自定义小组件 **{name}**\nID: `{wid}`\n类型：{wtype}\nURL: {url}"
+_JITSI_TMPL = "已添加 Jitsi 会议小组件\n会议链接：{url}\nWidget ID: `{wid}`"
+_ETHERPAD_TMPL = "已添加 Etherpad 协作文档小组件\n文档链接：{url}\nWidget ID: `{wid}`"
+_YOUTUBE_TMPL = "已添加 YouTube 视频小组件\n视频 ID: {slug}\nWidget ID: `{wid}`"
+_SEARCH_FOOTER = "\n\n使用 `/music play <序号>` 播放歌曲\n使用 `/music mode widget|link` 切换输出模式"
+_URL_PREVIEW_LEN = 50
+_WIDGET_ROW = "- **{name}** (`{wid}`)\n  类型：{wtype}\n  URL: {url}\n  创建者：{creator}\n"
+
+
+def _requires_matrix(func):
+    """小组件命令装饰器
+
+    在非 Matrix 平台上直接回复错误，否则将 client 与 room_id 注入到 event 之后的参数中。
+    对外暴露的签名会去掉这两个参数，避免被当作命令参数解析。
+    """
+
+    @functools.wraps(func)
+    async def wrapper(self, event: AstrMessageEvent, *args, **kwargs):
+        client = self._get_matrix_client(event)
+        if not client:
+            yield event.plain_result(_ERR_NOT_MATRIX)
+            return
+
+        async for result in func(self, event, client, event.get_session_id(), *args, **kwargs):
+            yield result
+
+    sig = inspect.signature(func)
+    params = list(sig.parameters.values())
+    wrapper.__signature__ = sig.replace(parameters=params[:2] + params[4:])
+    return wrapper
+
+
+@dataclass(slots=True)
+class Song:
+    """音乐搜索结果条目"""
+
+    id: str
+    name: str
+    artist: str
+    album: str
+    platform: str
+    url: str
+    embed_url: str
+
+
+_K = TypeVar("_K")
+_V = TypeVar("_V")
+
+
+class _LRU(OrderedDict[_K, _V]):
+    """容量有限的 LRU 字典，超出 maxsize 时淘汰最久未访问的键"""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key: _K, value: _V) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
 
 class Main(Star):
+    # Star 本身未声明 __slots__，实例仍保留 __dict__；此处仅让常用属性走槽位访问
+    __slots__ = (
+        "context",
+        "_client_cache",
+        "_rand_pool",
+        "_rand_off",
+        "_music_cache",
+        "_music_mode",
+        "_search_cache",
+        "_http",
+    )
+
     def __init__(self, context: Context) -> None:
         super().__init__(context)
         self.context = context
+        # 缓存已解析的 Matrix 平台实例 (platform_id -> platform)，弱引用以免阻止平台被回收
+        self._client_cache: weakref.WeakValueDictionary[str, object] = weakref.WeakValueDictionary()
+        # 预取的随机字节池，用于批量生成小组件 ID
+        self._rand_pool = bytearray()
+        self._rand_off = 0
         # 存储每个用户的搜索结果缓存
-        self._music_cache: dict[str, list[dict]] = {}
+        self._music_cache: _LRU[str, list[Song]] = _LRU(1024)
         # 存储每个用户的输出模式偏好 (widget/link)
-        self._music_mode: dict[str, str] = {}
+        self._music_mode: _LRU[str, str] = _LRU(1024)
+        # 音乐搜索结果缓存 ((搜索方法, 关键词) -> (时间戳, 结果))
+        self._search_cache: _LRU[tuple[str, str], tuple[float, list[Song]]] = _LRU(256)
+        # 音乐搜索共用的 HTTP 会话，首次使用时创建
+        self._http: aiohttp.ClientSession | None = None
+
+    async def terminate(self) -> None:
+        """插件卸载时关闭共享的 HTTP 会话"""
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        self._http = None
+
+    async def _get_http(self) -> aiohttp.ClientSession:
+        """获取共享的 HTTP 会话，复用连接池与 keep-alive 连接"""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=20,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=75,
+                ),
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
+        return self._http
 
     def _get_matrix_client(self, event: AstrMessageEvent):
         """获取 Matrix 客户端实例"""
         # 检查是否是 Matrix 平台
-        if event.get_platform_name() != "matrix":
+        if event.get_platform_name() not in _MATRIX_PLATFORMS:
             return None
 
-        # 尝试从平台适配器获取客户端
+        pid = event.get_platform_id()
         try:
-            for platform in self.context.platform_manager.platform_insts:
+            platform_insts = self.context.platform_manager.platform_insts
+            # 命中缓存时确认平台仍在运行，并始终取其当前的 client
+            cached = self._client_cache.get(pid)
+            if cached is not None and cached in platform_insts:
+                client = getattr(cached, "client", None)
+                if client is not None:
+                    return client
+
+            # 尝试从平台适配器获取客户端
+            self._client_cache.pop(pid, None)
+            for platform in platform_insts:
                 meta = platform.meta()
-                if meta.name == "matrix" and meta.id == event.get_platform_id():
-                    if hasattr(platform, "client"):
-                        return platform.client
+                if meta.name in _MATRIX_PLATFORMS and meta.id == pid:
+                    client = getattr(platform, "client", None)
+                    if client is not None:
+                        self._client_cache[pid] = platform
+                        return client
         except Exception as e:
-            logger.debug(f"获取 Matrix 客户端失败：{e}")
+            self._client_cache.pop(pid, None)
+            logger.debug("获取 Matrix 客户端失败：%s", e)
 
         return None
 
+    def _rand_hex(self, nbytes: int) -> str:
+        """从随机字节池中取出 nbytes 字节并返回十六进制字符串"""
+        off = self._rand_off
+        if off + nbytes > len(self._rand_pool):
+            self._rand_pool = bytearray(urandom(4096))
+            off = 0
+        self._rand_off = off + nbytes
+        return self._rand_pool[off : off + nbytes].hex()
+
+    def _invalidate_client(self, event: AstrMessageEvent) -> None:
+        """客户端调用出错时丢弃缓存的平台，下次调用时重新解析"""
+        self._client_cache.pop(event.get_platform_id(), None)
+
+    # 命令组函数只是注册标记，分发子命令时不会被调用；docstring 作为帮助文本保留
     @filter.command_group("widget")
     def widget_group(self):
         """Matrix 小组件管理命令"""
 
+    @staticmethod
+    def _format_widget(w: dict) -> str:
+        """格式化单个小组件的列表条目"""
+        content = w.get("content", {})
+        url = content.get("url", "")
+        shown_url = url if len(url) <= _URL_PREVIEW_LEN else url[:_URL_PREVIEW_LEN] + "..."
+        return _WIDGET_ROW.format(
+            name=content.get("name", "未命名"),
+            wid=content.get("id") or w.get("state_key", "unknown"),
+            wtype=content.get("type", "unknown"),
+            url=shown_url,
+            creator=content.get("creatorUserId", "unknown"),
+        )
+
     @widget_group.command("list")
-    async def widget_list(self, event: AstrMessageEvent):
+    @_requires_matrix
+    async def widget_list(self, event: AstrMessageEvent, client: "MatrixHTTPClient", room_id: str):
         """列出当前房间的所有小组件
 
         用法：/widget list
         """
-        client = self._get_matrix_client(event)
-        if not client:
-            yield event.plain_result("此命令仅在 Matrix 平台可用")
-            return
-
-        room_id = event.get_session_id()
+        plain = event.plain_result
 
         try:
             widgets = await client.get_widgets(room_id)
 
             if not widgets:
-                yield event.plain_result("当前房间没有小组件")
+                yield plain("当前房间没有小组件")
                 return
 
-            lines = ["**当前房间的小组件:**\n"]
-            for w in widgets:
-                content = w.get("content", {})
-                widget_id = content.get("id") or w.get("state_key", "unknown")
-                name = content.get("name", "未命名")
-                widget_type = content.get("type", "unknown")
-                url = content.get("url", "")
-                creator = content.get("creatorUserId", "unknown")
-
-                lines.append(f"- **{name}** (`{widget_id}`)")
-                lines.append(f"  类型：{widget_type}")
-                lines.append(f"  URL: {url[:50]}..." if len(url) > 50 else f"  URL: {url}")
-                lines.append(f"  创建者：{creator}")
-                lines.append("")
-
-            yield event.plain_result("\n".join(lines))
+            rows = "\n".join(self._format_widget(w) for w in widgets)
+            yield plain("**当前房间的小组件:**\n\n" + rows)
 
         except Exception as e:
-            logger.error(f"获取小组件列表失败：{e}")
-            yield event.plain_result(f"获取小组件列表失败：{e}")
+            self._invalidate_client(event)
+            msg = str(e)
+            logger.error("获取小组件列表失败：%s", msg)
+            yield plain(f"获取小组件列表失败：{msg}")
 
     @widget_group.command("add")
-    async def widget_add(self, event: AstrMessageEvent, name: str, url: str, widget_type: str = "customwidget"):
+    @_requires_matrix
+    async def widget_add(
+        self,
+        event: AstrMessageEvent,
+        client: "MatrixHTTPClient",
+        room_id: str,
+        name: str,
+        url: str,
+        widget_type: str = "customwidget",
+    ):
         """添加小组件到当前房间
 
         用法：/widget add <名称> <URL> [类型]
@@ -105,18 +297,13 @@ class Main(Star):
             /widget add "我的网页" https://example.com
             /widget add "Jitsi 会议" https://meet.jit.si/myroom jitsi
         """
-        client = self._get_matrix_client(event)
-        if not client:
-            yield event.plain_result("此命令仅在 Matrix 平台可用")
-            return
-
-        room_id = event.get_session_id()
+        plain = event.plain_result
 
         # 生成唯一的 widget ID
-        widget_id = f"astrbot_{secrets.token_hex(8)}"
+        widget_id = "astrbot_" + self._rand_hex(8)
 
         try:
-            result = await client.add_widget(
+            await client.add_widget(
                 room_id=room_id,
                 widget_id=widget_id,
                 widget_type=widget_type,
@@ -124,20 +311,17 @@ class Main(Star):
                 name=name,
             )
 
-            event_id = result.get("event_id", "unknown")
-            yield event.plain_result(
-                f"已添加小组件 **{name}**\n"
-                f"ID: `{widget_id}`\n"
-                f"类型：{widget_type}\n"
-                f"URL: {url}"
-            )
+            yield plain(_ADD_TMPL.format(name=name, wid=widget_id, wtype=widget_type, url=url))
 
         except Exception as e:
-            logger.error(f"添加小组件失败：{e}")
-            yield event.plain_result(f"添加小组件失败：{e}")
+            self._invalidate_client(event)
+            msg = str(e)
+            logger.error("添加小组件失败：%s", msg)
+            yield plain(f"添加小组件失败：{msg}")
 
     @widget_group.command("remove")
-    async def widget_remove(self, event: AstrMessageEvent, widget_id: str):
+    @_requires_matrix
+    async def widget_remove(self, event: AstrMessageEvent, client: "MatrixHTTPClient", room_id: str, widget_id: str):
         """从当前房间移除小组件
 
         用法：/widget remove <widget_id>
@@ -148,23 +332,68 @@ class Main(Star):
         示例：
             /widget remove astrbot_abc123
         """
-        client = self._get_matrix_client(event)
-        if not client:
-            yield event.plain_result("此命令仅在 Matrix 平台可用")
-            return
-
-        room_id = event.get_session_id()
+        plain = event.plain_result
 
         try:
             await client.remove_widget(room_id, widget_id)
-            yield event.plain_result(f"已移除小组件 `{widget_id}`")
+            yield plain(f"已移除小组件 `{widget_id}`")
 
         except Exception as e:
-            logger.error(f"移除小组件失败：{e}")
-            yield event.plain_result(f"移除小组件失败：{e}")
+            self._invalidate_client(event)
+            msg = str(e)
+            logger.error("移除小组件失败：%s", msg)
+            yield plain(f"移除小组件失败：{msg}")
+
+    async def _quick_widget(
+        self,
+        event: AstrMessageEvent,
+        client: "MatrixHTTPClient",
+        room_id: str,
+        *,
+        kind: str,
+        widget_type: str,
+        label: str,
+        slug: str,
+        url: str,
+        reply_tmpl: str,
+        data: dict | None = None,
+    ):
+        """添加预设类型的小组件并回复结果
+
+        kind 用作小组件 ID 前缀，label 用于显示名称与错误提示。
+        reply_tmpl 可使用 {wid}、{url}、{slug} 占位符。
+        """
+        plain = event.plain_result
+        widget_id = kind + "_" + self._rand_hex(8)
+        kwargs = {"data": data} if data is not None else {}
+
+        try:
+            await client.add_widget(
+                room_id=room_id,
+                widget_id=widget_id,
+                widget_type=widget_type,
+                url=url,
+                name=f"{label}: {slug}",
+                **kwargs,
+            )
+
+            yield plain(reply_tmpl.format(wid=widget_id, url=url, slug=slug))
+
+        except Exception as e:
+            self._invalidate_client(event)
+            msg = str(e)
+            logger.error("添加 %s 小组件失败：%s", label, msg)
+            yield plain(f"添加 {label} 小组件失败：{msg}")
 
     @widget_group.command("jitsi")
-    async def widget_jitsi(self, event: AstrMessageEvent, room_name: str = ""):
+    @_requires_matrix
+    async def widget_jitsi(
+        self,
+        event: AstrMessageEvent,
+        client: "MatrixHTTPClient",
+        room_id: str,
+        room_name: str = "",
+    ):
         """快速添加 Jitsi 视频会议小组件
 
         用法：/widget jitsi [房间名]
@@ -176,45 +405,34 @@ class Main(Star):
             /widget jitsi
             /widget jitsi mymeeting
         """
-        client = self._get_matrix_client(event)
-        if not client:
-            yield event.plain_result("此命令仅在 Matrix 平台可用")
-            return
-
-        room_id = event.get_session_id()
-
         # 生成房间名
         if not room_name:
-            room_name = f"astrbot_{secrets.token_hex(6)}"
-
-        widget_id = f"jitsi_{secrets.token_hex(8)}"
-        jitsi_url = f"https://meet.jit.si/{room_name}"
-
-        try:
-            await client.add_widget(
-                room_id=room_id,
-                widget_id=widget_id,
-                widget_type="jitsi",
-                url=jitsi_url,
-                name=f"Jitsi: {room_name}",
-                data={
-                    "domain": "meet.jit.si",
-                    "conferenceId": room_name,
-                },
-            )
-
-            yield event.plain_result(
-                f"已添加 Jitsi 会议小组件\n"
-                f"会议链接：{jitsi_url}\n"
-                f"Widget ID: `{widget_id}`"
-            )
-
-        except Exception as e:
-            logger.error(f"添加 Jitsi 小组件失败：{e}")
-            yield event.plain_result(f"添加 Jitsi 小组件失败：{e}")
+            room_name = "astrbot_" + self._rand_hex(6)
+
+        jitsi_url = "https://meet.jit.si/" + room_name
+        async for result in self._quick_widget(
+            event,
+            client,
+            room_id,
+            kind="jitsi",
+            widget_type="jitsi",
+            label="Jitsi",
+            slug=room_name,
+            url=jitsi_url,
+            reply_tmpl=_JITSI_TMPL,
+            data={"domain": "meet.jit.si", "conferenceId": room_name},
+        ):
+            yield result
 
     @widget_group.command("etherpad")
-    async def widget_etherpad(self, event: AstrMessageEvent, pad_name: str = ""):
+    @_requires_matrix
+    async def widget_etherpad(
+        self,
+        event: AstrMessageEvent,
+        client: "MatrixHTTPClient",
+        room_id: str,
+        pad_name: str = "",
+    ):
         """快速添加 Etherpad 协作文档小组件
 
         用法：/widget etherpad [文档名]
@@ -226,42 +444,28 @@ class Main(Star):
             /widget etherpad
             /widget etherpad meeting-notes
         """
-        client = self._get_matrix_client(event)
-        if not client:
-            yield event.plain_result("此命令仅在 Matrix 平台可用")
-            return
-
-        room_id = event.get_session_id()
-
         # 生成文档名
         if not pad_name:
-            pad_name = f"astrbot_{secrets.token_hex(6)}"
+            pad_name = "astrbot_" + self._rand_hex(6)
 
-        widget_id = f"etherpad_{secrets.token_hex(8)}"
         # 使用公共 Etherpad 服务
-        etherpad_url = f"https://etherpad.wikimedia.org/p/{pad_name}"
-
-        try:
-            await client.add_widget(
-                room_id=room_id,
-                widget_id=widget_id,
-                widget_type="etherpad",
-                url=etherpad_url,
-                name=f"Etherpad: {pad_name}",
-            )
-
-            yield event.plain_result(
-                f"已添加 Etherpad 协作文档小组件\n"
-                f"文档链接：{etherpad_url}\n"
-                f"Widget ID: `{widget_id}`"
-            )
-
-        except Exception as e:
-            logger.error(f"添加 Etherpad 小组件失败：{e}")
-            yield event.plain_result(f"添加 Etherpad 小组件失败：{e}")
+        etherpad_url = "https://etherpad.wikimedia.org/p/" + pad_name
+        async for result in self._quick_widget(
+            event,
+            client,
+            room_id,
+            kind="etherpad",
+            widget_type="etherpad",
+            label="Etherpad",
+            slug=pad_name,
+            url=etherpad_url,
+            reply_tmpl=_ETHERPAD_TMPL,
+        ):
+            yield result
 
     @widget_group.command("youtube")
-    async def widget_youtube(self, event: AstrMessageEvent, video_id: str):
+    @_requires_matrix
+    async def widget_youtube(self, event: AstrMessageEvent, client: "MatrixHTTPClient", room_id: str, video_id: str):
         """添加 YouTube 视频小组件
 
         用法：/widget youtube <视频 ID 或 URL>
@@ -273,46 +477,32 @@ class Main(Star):
             /widget youtube dQw4w9WgXcQ
             /widget youtube https://www.youtube.com/watch?v=dQw4w9WgXcQ
         """
-        client = self._get_matrix_client(event)
-        if not client:
-            yield event.plain_result("此命令仅在 Matrix 平台可用")
-            return
-
-        room_id = event.get_session_id()
-
         # 从 URL 提取视频 ID
-        if "youtube.com" in video_id or "youtu.be" in video_id:
-            if "v=" in video_id:
-                video_id = video_id.split("v=")[1].split("&")[0]
-            elif "youtu.be/" in video_id:
-                video_id = video_id.split("youtu.be/")[1].split("?")[0]
-
-        widget_id = f"youtube_{secrets.token_hex(8)}"
-        youtube_url = f"https://www.youtube.com/embed/{video_id}"
-
-        try:
-            await client.add_widget(
-                room_id=room_id,
-                widget_id=widget_id,
-                widget_type="video",
-                url=youtube_url,
-                name=f"YouTube: {video_id}",
-            )
-
-            yield event.plain_result(
-                f"已添加 YouTube 视频小组件\n"
-                f"视频 ID: {video_id}\n"
-                f"Widget ID: `{widget_id}`"
-            )
-
-        except Exception as e:
-            logger.error(f"添加 YouTube 小组件失败：{e}")
-            yield event.plain_result(f"添加 YouTube 小组件失败：{e}")
+        m = _YT_RE.search(video_id)
+        if m:
+            video_id = m.group(1)
+
+        youtube_url = "https://www.youtube.com/embed/" + video_id
+        async for result in self._quick_widget(
+            event,
+            client,
+            room_id,
+            kind="youtube",
+            widget_type="video",
+            label="YouTube",
+            slug=video_id,
+            url=youtube_url,
+            reply_tmpl=_YOUTUBE_TMPL,
+        ):
+            yield result
 
     @widget_group.command("custom")
+    @_requires_matrix
     async def widget_custom(
         self,
         event: AstrMessageEvent,
+        client: "MatrixHTTPClient",
+        room_id: str,
         widget_id: str,
         name: str,
         url: str,
@@ -336,15 +526,10 @@ class Main(Star):
         示例：
             /widget custom mywidget "我的工具" "https://example.com?room=$matrix_room_id"
         """
-        client = self._get_matrix_client(event)
-        if not client:
-            yield event.plain_result("此命令仅在 Matrix 平台可用")
-            return
-
-        room_id = event.get_session_id()
+        plain = event.plain_result
 
         try:
-            result = await client.add_widget(
+            await client.add_widget(
                 room_id=room_id,
                 widget_id=widget_id,
                 widget_type=widget_type,
@@ -352,16 +537,13 @@ class Main(Star):
                 name=name,
             )
 
-            yield event.plain_result(
-                f"已添加自定义小组件 **{name}**\n"
-                f"ID: `{widget_id}`\n"
-                f"类型：{widget_type}\n"
-                f"URL: {url}"
-            )
+            yield plain(_CUSTOM_TMPL.format(name=name, wid=widget_id, wtype=widget_type, url=url))
 
         except Exception as e:
-            logger.error(f"添加自定义小组件失败：{e}")
-            yield event.plain_result(f"添加自定义小组件失败：{e}")
+            self._invalidate_client(event)
+            msg = str(e)
+            logger.error("添加自定义小组件失败：%s", msg)
+            yield plain(f"添加自定义小组件失败：{msg}")
 
     # ==================== 音乐点歌功能 ====================
 
@@ -369,7 +551,24 @@ class Main(Star):
     def music_group(self):
         """音乐点歌命令组"""
 
-    async def _search_netease(self, keyword: str) -> list[dict]:
+    # 平台别名 -> (搜索方法名, 显示名称)
+    _PLATFORM_DISPATCH: ClassVar[dict[str, tuple[str, str]]] = {
+        "netease": ("_search_netease", "网易云音乐"),
+        "163": ("_search_netease", "网易云音乐"),
+        "网易": ("_search_netease", "网易云音乐"),
+        "qq": ("_search_qq", "QQ 音乐"),
+        "qqmusic": ("_search_qq", "QQ 音乐"),
+        "腾讯": ("_search_qq", "QQ 音乐"),
+        "youtube": ("_search_youtube", "YouTube"),
+        "yt": ("_search_youtube", "YouTube"),
+        "ytb": ("_search_youtube", "YouTube"),
+        "all": ("_search_all", "全部平台"),
+        "全部": ("_search_all", "全部平台"),
+    }
+    # /music mode 可选的输出模式
+    _VALID_MODES: ClassVar[frozenset[str]] = frozenset({"widget", "link"})
+
+    async def _search_netease(self, keyword: str) -> list[Song]:
         """网易云音乐搜索"""
         url = "https://music.163.com/api/search/get/web"
         params = {
@@ -378,34 +577,30 @@ class Main(Star):
             "offset": 0,
             "limit": 10,
         }
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Referer": "https://music.163.com/",
-        }
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, data=params, headers=headers) as resp:
-                    if resp.status != 200:
-                        return []
-                    data = await resp.json()
-                    songs = data.get("result", {}).get("songs", [])
-                    return [
-                        {
-                            "id": str(song["id"]),
-                            "name": song["name"],
-                            "artist": "/".join(a["name"] for a in song.get("artists", [])),
-                            "album": song.get("album", {}).get("name", ""),
-                            "platform": "netease",
-                            "url": f"https://music.163.com/#/song?id={song['id']}",
-                            "embed_url": f"https://music.163.com/outchain/player?type=2&id={song['id']}&auto=1&height=66",
-                        }
-                        for song in songs
-                    ]
+            session = await self._get_http()
+            async with session.post(url, data=params, headers=_NETEASE_HEADERS) as resp:
+                if resp.status != 200:
+                    return []
+                data = _json_loads(await resp.read())
+                songs = data.get("result", {}).get("songs", [])
+                return [
+                    Song(
+                        id=str(song["id"]),
+                        name=song["name"],
+                        artist="/".join(map(_get_name, song.get("artists") or ())),
+                        album=song.get("album", {}).get("name", ""),
+                        platform="netease",
+                        url=f"https://music.163.com/#/song?id={song['id']}",
+                        embed_url=f"https://music.163.com/outchain/player?type=2&id={song['id']}&auto=1&height=66",
+                    )
+                    for song in songs
+                ]
         except Exception as e:
-            logger.error(f"网易云音乐搜索失败：{e}")
+            logger.error("网易云音乐搜索失败：%s", e)
             return []
 
-    async def _search_qq(self, keyword: str) -> list[dict]:
+    async def _search_qq(self, keyword: str) -> list[Song]:
         """QQ 音乐搜索"""
         url = "https://c.y.qq.com/soso/fcgi-bin/client_search_cp"
         params = {
@@ -414,106 +609,138 @@ class Main(Star):
             "p": 1,
             "n": 10,
         }
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Referer": "https://y.qq.com/",
-        }
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, headers=headers) as resp:
-                    if resp.status != 200:
-                        return []
-                    data = await resp.json()
-                    songs = data.get("data", {}).get("song", {}).get("list", [])
-                    return [
-                        {
-                            "id": song["songmid"],
-                            "name": song["songname"],
-                            "artist": "/".join(s["name"] for s in song.get("singer", [])),
-                            "album": song.get("albumname", ""),
-                            "platform": "qq",
-                            "url": f"https://y.qq.com/n/ryqq/songDetail/{song['songmid']}",
-                            "embed_url": f"https://i.y.qq.com/v8/playsong.html?songmid={song['songmid']}&type=0",
-                        }
-                        for song in songs
-                    ]
+            session = await self._get_http()
+            async with session.get(url, params=params, headers=_QQ_HEADERS) as resp:
+                if resp.status != 200:
+                    return []
+                data = _json_loads(await resp.read())
+                songs = data.get("data", {}).get("song", {}).get("list", [])
+                return [
+                    Song(
+                        id=song["songmid"],
+                        name=song["songname"],
+                        artist="/".join(map(_get_name, song.get("singer") or ())),
+                        album=song.get("albumname", ""),
+                        platform="qq",
+                        url=f"https://y.qq.com/n/ryqq/songDetail/{song['songmid']}",
+                        embed_url=f"https://i.y.qq.com/v8/playsong.html?songmid={song['songmid']}&type=0",
+                    )
+                    for song in songs
+                ]
         except Exception as e:
-            logger.error(f"QQ 音乐搜索失败：{e}")
+            logger.error("QQ 音乐搜索失败：%s", e)
             return []
 
-    async def _search_youtube(self, keyword: str) -> list[dict]:
+    async def _search_youtube(self, keyword: str) -> list[Song]:
         """YouTube 音乐搜索 (使用 Invidious API)"""
         # 使用公共 Invidious 实例进行搜索
         url = "https://inv.nadeko.net/api/v1/search"
         params = {
             "q": keyword,
             "type": "video",
-        }
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+            # 只请求用到的字段以缩小响应体
+            "fields": "type,videoId,title,author",
         }
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, headers=headers) as resp:
-                    if resp.status != 200:
-                        return []
-                    data = await resp.json()
-                    return [
-                        {
-                            "id": video["videoId"],
-                            "name": video["title"],
-                            "artist": video.get("author", ""),
-                            "album": "",
-                            "platform": "youtube",
-                            "url": f"https://www.youtube.com/watch?v={video['videoId']}",
-                            "embed_url": f"https://www.youtube.com/embed/{video['videoId']}",
-                        }
-                        for video in data[:10]
-                        if video.get("type") == "video"
-                    ]
+            session = await self._get_http()
+            async with session.get(url, params=params, headers=_YT_HEADERS) as resp:
+                if resp.status != 200:
+                    return []
+                data = _json_loads(await resp.read())
+                results = []
+                for video in data:
+                    if video.get("type") != "video":
+                        continue
+                    results.append(
+                        Song(
+                            id=video["videoId"],
+                            name=video["title"],
+                            artist=video.get("author", ""),
+                            album="",
+                            platform="youtube",
+                            url=f"https://www.youtube.com/watch?v={video['videoId']}",
+                            embed_url=f"https://www.youtube.com/embed/{video['videoId']}",
+                        )
+                    )
+                    if len(results) >= 10:
+                        break
+                return results
         except Exception as e:
-            logger.error(f"YouTube 搜索失败：{e}")
+            logger.error("YouTube 搜索失败：%s", e)
             return []
 
-    async def _search_spotify(self, keyword: str) -> list[dict]:
+    async def _search_spotify(self, keyword: str) -> list[Song]:
         """Spotify 搜索 (使用公开 embed 链接)"""
         # Spotify 不提供公开 API，使用搜索结果页面
         # 这里只提供直接输入 track ID 的方式
         # 如果输入看起来像 Spotify URL 或 track ID，直接返回
-        track_id = None
-        if "spotify.com/track/" in keyword:
-            track_id = keyword.split("spotify.com/track/")[1].split("?")[0]
+        m = _SPOTIFY_RE.search(keyword)
+        if m:
+            track_id = m.group(1)
         elif len(keyword) == 22 and keyword.isalnum():
             track_id = keyword
+        else:
+            track_id = None
 
         if track_id:
             return [
-                {
-                    "id": track_id,
-                    "name": f"Spotify Track: {track_id}",
-                    "artist": "",
-                    "album": "",
-                    "platform": "spotify",
-                    "url": f"https://open.spotify.com/track/{track_id}",
-                    "embed_url": f"https://open.spotify.com/embed/track/{track_id}",
-                }
+                Song(
+                    id=track_id,
+                    name=f"Spotify Track: {track_id}",
+                    artist="",
+                    album="",
+                    platform="spotify",
+                    url=f"https://open.spotify.com/track/{track_id}",
+                    embed_url=f"https://open.spotify.com/embed/track/{track_id}",
+                )
             ]
         return []
 
-    def _format_search_results(self, songs: list[dict], platform: str) -> str:
-        """格式化搜索结果"""
+    async def _cached_search(self, keyword: str, fn) -> list[Song]:
+        """带 TTL 的搜索结果缓存，以 (搜索方法, 小写关键词) 为键
+
+        空结果 (包括请求失败) 不缓存，以便下次重新请求。
+        """
+        key = (fn.__name__, keyword.lower())
+        hit = self._search_cache.get(key)
+        now = time.monotonic()
+        if hit is not None and now - hit[0] < _SEARCH_CACHE_TTL:
+            return hit[1]
+
+        songs = await fn(keyword)
+        if songs:
+            self._search_cache[key] = (now, songs)
+        return songs
+
+    async def _search_all(self, keyword: str) -> list[Song]:
+        """并发搜索网易云、QQ 音乐与 YouTube，并按平台交替合并结果"""
+        results = await asyncio.gather(
+            self._cached_search(keyword, self._search_netease),
+            self._cached_search(keyword, self._search_qq),
+            self._cached_search(keyword, self._search_youtube),
+            return_exceptions=True,
+        )
+        lists = [r for r in results if isinstance(r, list)]
+        return [song for row in itertools.zip_longest(*lists) for song in row if song is not None]
+
+    def _format_search_results(self, songs: list[Song], platform: str, show_platform: bool = False) -> str:
+        """格式化搜索结果
+
+        show_platform 为 True 时在每首歌前标注来源平台 (用于全平台搜索)。
+        """
         if not songs:
             return f"未找到相关歌曲 ({platform})"
 
-        lines = [f"**{platform} 搜索结果:**\n"]
-        for i, song in enumerate(songs, 1):
-            artist = f" - {song['artist']}" if song["artist"] else ""
-            album = f" [{song['album']}]" if song["album"] else ""
-            lines.append(f"{i}. **{song['name']}**{artist}{album}")
-
-        lines.append("\n使用 `/music play <序号>` 播放歌曲")
-        lines.append("使用 `/music mode widget|link` 切换输出模式")
-        return "\n".join(lines)
+        body = "\n".join(
+            f"{i}. "
+            + (f"[{_PLATFORM_DISPLAY_NAMES.get(song.platform, song.platform)}] " if show_platform else "")
+            + f"**{song.name}**"
+            + (f" - {song.artist}" if song.artist else "")
+            + (f" [{song.album}]" if song.album else "")
+            for i, song in enumerate(songs, 1)
+        )
+        return f"**{platform} 搜索结果:**\n\n" + body + _SEARCH_FOOTER
 
     @music_group.command("netease")
     async def music_netease(self, event: AstrMessageEvent, keyword: str):
@@ -525,7 +752,7 @@ class Main(Star):
             /music netease 周杰伦 稻香
         """
         user_id = event.get_sender_id()
-        songs = await self._search_netease(keyword)
+        songs = await self._cached_search(keyword, self._search_netease)
         self._music_cache[user_id] = songs
         yield event.plain_result(self._format_search_results(songs, "网易云音乐"))
 
@@ -539,7 +766,7 @@ class Main(Star):
             /music qq 林俊杰 江南
         """
         user_id = event.get_sender_id()
-        songs = await self._search_qq(keyword)
+        songs = await self._cached_search(keyword, self._search_qq)
         self._music_cache[user_id] = songs
         yield event.plain_result(self._format_search_results(songs, "QQ 音乐"))
 
@@ -553,7 +780,7 @@ class Main(Star):
             /music youtube lofi hip hop
         """
         user_id = event.get_sender_id()
-        songs = await self._search_youtube(keyword)
+        songs = await self._cached_search(keyword, self._search_youtube)
         self._music_cache[user_id] = songs
         yield event.plain_result(self._format_search_results(songs, "YouTube"))
 
@@ -574,7 +801,7 @@ class Main(Star):
             yield event.plain_result(
                 f"已识别 Spotify 曲目\n"
                 f"使用 `/music play 1` 播放\n"
-                f"链接：{songs[0]['url']}"
+                f"链接：{songs[0].url}"
             )
         else:
             yield event.plain_result(
@@ -598,7 +825,7 @@ class Main(Star):
             /music mode link
         """
         user_id = event.get_sender_id()
-        if mode not in ("widget", "link"):
+        if mode not in self._VALID_MODES:
             yield event.plain_result("模式必须是 `widget` 或 `link`")
             return
 
@@ -631,18 +858,12 @@ class Main(Star):
 
         if mode == "link":
             # 链接模式：直接发送播放链接
-            platform_names = {
-                "netease": "网易云音乐",
-                "qq": "QQ 音乐",
-                "youtube": "YouTube",
-                "spotify": "Spotify",
-            }
-            platform_name = platform_names.get(song["platform"], song["platform"])
+            platform_name = _PLATFORM_DISPLAY_NAMES.get(song.platform, song.platform)
             yield event.plain_result(
-                f"**{song['name']}**\n"
-                f"歌手：{song['artist']}\n"
+                f"**{song.name}**\n"
+                f"歌手：{song.artist}\n"
                 f"平台：{platform_name}\n"
-                f"链接：{song['url']}"
+                f"链接：{song.url}"
             )
         else:
             # 小组件模式：添加播放器小组件
@@ -650,35 +871,36 @@ class Main(Star):
             if not client:
                 # 非 Matrix 平台时回退到链接模式
                 yield event.plain_result(
-                    f"**{song['name']}** - {song['artist']}\n"
-                    f"链接：{song['url']}"
+                    f"**{song.name}** - {song.artist}\n"
+                    f"链接：{song.url}"
                 )
                 return
 
             room_id = event.get_session_id()
-            widget_id = f"music_{song['platform']}_{secrets.token_hex(8)}"
+            widget_id = "music_" + song.platform + "_" + self._rand_hex(8)
 
             try:
                 await client.add_widget(
                     room_id=room_id,
                     widget_id=widget_id,
                     widget_type="customwidget",
-                    url=song["embed_url"],
-                    name=f"♪ {song['name']} - {song['artist']}",
+                    url=song.embed_url,
+                    name=f"♪ {song.name} - {song.artist}",
                 )
 
                 yield event.plain_result(
                     f"已添加音乐小组件\n"
-                    f"**{song['name']}** - {song['artist']}\n"
+                    f"**{song.name}** - {song.artist}\n"
                     f"Widget ID: `{widget_id}`"
                 )
             except Exception as e:
-                logger.error(f"添加音乐小组件失败：{e}")
+                self._invalidate_client(event)
+                logger.error("添加音乐小组件失败：%s", e)
                 # 失败时回退到链接模式
                 yield event.plain_result(
                     f"添加小组件失败，发送链接:\n"
-                    f"**{song['name']}** - {song['artist']}\n"
-                    f"链接：{song['url']}"
+                    f"**{song.name}** - {song.artist}\n"
+                    f"链接：{song.url}"
                 )
 
     @music_group.command("search")
@@ -689,30 +911,30 @@ class Main(Star):
 
         参数：
             keyword: 搜索关键词
-            platform: 平台 (netease/qq/youtube，默认 netease)
+            platform: 平台 (netease/qq/youtube/all，默认 netease)
 
         示例：
             /music search 周杰伦
             /music search Taylor Swift youtube
+            /music search 稻香 all
         """
         user_id = event.get_sender_id()
 
         platform = platform.lower()
-        if platform in ("netease", "163", "网易"):
-            songs = await self._search_netease(keyword)
-            platform_name = "网易云音乐"
-        elif platform in ("qq", "qqmusic", "腾讯"):
-            songs = await self._search_qq(keyword)
-            platform_name = "QQ 音乐"
-        elif platform in ("youtube", "yt", "ytb"):
-            songs = await self._search_youtube(keyword)
-            platform_name = "YouTube"
-        else:
+        entry = self._PLATFORM_DISPATCH.get(platform)
+        if entry is None:
             yield event.plain_result(
                 f"不支持的平台：{platform}\n"
-                "支持的平台：netease, qq, youtube"
+                "支持的平台：netease, qq, youtube, all"
             )
             return
 
+        method_name, platform_name = entry
+        search_all = method_name == "_search_all"
+        if search_all:
+            # 各子搜索已单独缓存，合并结果不再整体缓存，避免失败的平台被一并缓存
+            songs = await self._search_all(keyword)
+        else:
+            songs = await self._cached_search(keyword, getattr(self, method_name))
         self._music_cache[user_id] = songs
-        yield event.plain_result(self._format_search_results(songs, platform_name))
+        yield event.plain_result(self._format_search_results(songs, platform_name, show_platform=search_all))